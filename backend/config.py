@@ -0,0 +1,40 @@
+"""
+Application settings, read once from environment variables and backend/.env
+"""
+from pathlib import Path
+from typing import Annotated, List, Optional
+from pydantic import field_validator
+from pydantic_settings import BaseSettings, NoDecode, SettingsConfigDict
+
+
+class Settings(BaseSettings):
+    """Typed configuration; each field maps to the upper-case env var of the same name"""
+    model_config = SettingsConfigDict(env_file=Path(__file__).with_name(".env"), extra="ignore")
+
+    # Supabase
+    supabase_url: Optional[str] = None
+    supabase_key: Optional[str] = None
+
+    # Fulfillment webhook
+    fulfillment_webhook_url: Optional[str] = None
+    fulfillment_concurrency: int = 64  # Max webhook batches in flight at once
+
+    # Chat sessions (Redis is optional; without it sessions stay in process memory)
+    redis_url: Optional[str] = None  # e.g. redis://localhost:6379/0 or unix:///var/run/redis/redis.sock
+    session_ttl_seconds: int = 1800
+
+    # Server
+    cors_origins: Annotated[List[str], NoDecode] = ["http://localhost:3000", "http://localhost:8000"]
+    log_level: str = "INFO"
+    workers: int = 1
+
+    @field_validator("cors_origins", mode="before")
+    @classmethod
+    def split_cors_origins(cls, value):
+        """Accept the comma-separated form used in .env"""
+        if isinstance(value, str):
+            return [origin.strip() for origin in value.split(",") if origin.strip()]
+        return value
+
+
+settings = Settings()
@@ -1,14 +1,94 @@
 """
 Fulfillment trigger logic for food assistance requests
 """
+import asyncio
 import httpx
-import os
-from dotenv import load_dotenv
-from typing import Dict, Any
+import logging
+import orjson
+from typing import Dict, Any, List
+from config import settings
+from workers import BatchQueue, backoff_delay
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-FULFILLMENT_WEBHOOK_URL = os.getenv("FULFILLMENT_WEBHOOK_URL", None)
+FULFILLMENT_WEBHOOK_URL = settings.fulfillment_webhook_url
+
+WEBHOOK_MAX_ATTEMPTS = 5
+
+# Shared HTTP client so webhook calls reuse pooled keep-alive connections
+_client: httpx.AsyncClient | None = None
+
+
+async def get_client() -> httpx.AsyncClient:
+    """Return the shared webhook client, creating it on first use"""
+    global _client
+    if _client is None:
+        # HTTP/2 lets concurrent sends to the webhook host share one connection
+        _client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=50,
+                keepalive_expiry=30.0
+            ),
+            timeout=httpx.Timeout(connect=5.0, read=10.0, write=5.0, pool=5.0)
+        )
+    return _client
+
+
+async def close_client() -> None:
+    """Close the shared webhook client (called on application shutdown)"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _is_retryable(exc: Exception) -> bool:
+    """Network errors, 429 and 5xx responses are transient; other 4xx are permanent"""
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+class FulfillmentBatcher(BatchQueue):
+    """
+    Collect fulfillment payloads and send them to the webhook in batches
+    of up to max_batch_size, at most max_wait_time seconds after the first
+    payload arrives, with at most max_concurrency batches in flight.
+    """
+
+    def __init__(self, max_batch_size: int = 50, max_wait_time: float = 0.2, max_concurrency: int = 64):
+        super().__init__(self._send, max_batch_size, max_wait_time, max_concurrency=max_concurrency)
+
+    async def _send(self, batch: List[Dict[str, Any]]) -> bool:
+        """POST a batch to the webhook, retrying transient failures with backoff"""
+        body = orjson.dumps({"items": batch})
+        for attempt in range(WEBHOOK_MAX_ATTEMPTS):
+            try:
+                client = await get_client()
+                response = await client.post(
+                    FULFILLMENT_WEBHOOK_URL,
+                    content=body,
+                    headers={"Content-Type": "application/json"}
+                )
+                response.raise_for_status()
+                logger.info("Fulfillment batch sent successfully: %d item(s)", len(batch))
+                return True
+            except Exception as e:
+                if not _is_retryable(e) or attempt == WEBHOOK_MAX_ATTEMPTS - 1:
+                    logger.error("Error sending fulfillment batch (%d item(s)): %s", len(batch), e)
+                    return False
+                delay = backoff_delay(attempt)
+                logger.warning(
+                    "Error sending fulfillment batch (%d item(s)), retrying in %.1fs: %s",
+                    len(batch), delay, e
+                )
+                await asyncio.sleep(delay)
+        return False
+
+batcher = FulfillmentBatcher(max_concurrency=settings.fulfillment_concurrency)
 
 
 async def trigger_fulfillment_notification(data: Dict[str, Any]) -> bool:
@@ -24,22 +104,12 @@ async def trigger_fulfillment_notification(data: Dict[str, Any]) -> bool:
         "assistance_type": data.get("assistance_type")
     }
     
-    # If webhook URL is configured, send POST request
+    # If webhook URL is configured, queue the payload for the next batch
     if FULFILLMENT_WEBHOOK_URL:
-        try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.post(
-                    FULFILLMENT_WEBHOOK_URL,
-                    json=fulfillment_payload,
-                    headers={"Content-Type": "application/json"}
-                )
-                response.raise_for_status()
-                print(f"Fulfillment notification sent successfully: {fulfillment_payload}")
-                return True
-        except Exception as e:
-            print(f"Error sending fulfillment notification: {e}")
-            return False
+        await batcher.add(fulfillment_payload)
+        logger.info("Fulfillment notification queued: %r", fulfillment_payload)
+        return True
     
     # Fallback: log the fulfillment request
-    print(f"Fulfillment triggered (no webhook configured): {fulfillment_payload}")
+    logger.info("Fulfillment triggered (no webhook configured): %r", fulfillment_payload)
     return True
@@ -6,10 +6,117 @@ from langgraph.graph import StateGraph, END
 from langgraph.graph.message import add_messages
 from langchain_core.messages import HumanMessage, AIMessage
 import json
-from datetime import datetime
-from supabase_client import supabase
-import asyncio
+import re
+from datetime import datetime, timezone
+from supabase_client import supabase, store_rows
+import functools
+import logging
 from fulfillment import trigger_fulfillment_notification
+from workers import BatchQueue
+
+logger = logging.getLogger(__name__)
+
+# Rows waiting to be bulk-inserted into Supabase, through the same insert path
+# as the /chat endpoint. It starts on the first row; code that runs this
+# workflow must await supabase_batcher.stop() on shutdown to store what is queued.
+supabase_batcher = BatchQueue(store_rows, max_batch_size=100, max_wait_time=0.05, maxsize=1000)
+
+# Extraction patterns used by collect_user_info, compiled once at import
+# Patterns: "I'm John", "My name is John", "I am John", "name is John", "called John"
+_NAME_PATTERNS = [
+    re.compile(p, re.IGNORECASE) for p in (
+        r"(?:i'?m|i am|my name is|name is|called|this is)\s+([A-Z][a-z]+(?:\s+[A-Z][a-z]+)?)",
+        r"^([A-Z][a-z]+(?:\s+[A-Z][a-z]+)?)$"  # If entire message is just a name
+    )
+]
+# Patterns: "I am 25", "age is 25", "25 years old", "25"
+_AGE_PATTERNS = [
+    re.compile(p, re.IGNORECASE) for p in (
+        r"(?:i am|age is|i'?m|years old|year old)\s+(\d{1,3})",
+        r"\b(\d{1,3})\s*(?:years?|yrs?|old)?\b",
+        r"^(\d{1,3})$"  # If entire message is just a number
+    )
+]
+# Patterns: "I live in...", "location is...", "address is...", "at...", "in..."
+_LOCATION_PATTERNS = [
+    re.compile(p, re.IGNORECASE) for p in (
+        r"(?:i live in|location is|address is|i am at|i am in|at|in|near|area is|located at)\s+(.+)",
+        r"^(.+)$"  # If asked for location, entire message might be location
+    )
+]
+_LOC_PREFIX_RE = re.compile(
+    r"^(i live in|location is|address is|i am at|i am in|at|in|near|area is|located at)\s+",
+    re.IGNORECASE
+)
+
+# Intent routing rules, in priority order
+_URGENT_KEYWORDS = frozenset({"hungry", "starving", "need food now", "urgent", "immediate", "emergency", "asap"})
+_SCHEDULED_KEYWORDS = frozenset({"later", "tomorrow", "next week", "schedule", "plan"})
+_NGO_KEYWORDS = frozenset({"ngo", "referral", "support", "help", "assistance", "organization"})
+_INTENT_KEYWORDS = {
+    "immediate_food": _URGENT_KEYWORDS,
+    "scheduled_food": _SCHEDULED_KEYWORDS,
+    "ngo_referral": _NGO_KEYWORDS,
+}
+
+# Keyword -> intent lookup; a keyword listed under several intents keeps the
+# highest-priority one
+_KEYWORD_INTENT = {}
+for _intent, _keywords in _INTENT_KEYWORDS.items():
+    for _keyword in _keywords:
+        _KEYWORD_INTENT.setdefault(_keyword, _intent)
+_INTENT_RANK = {intent: rank for rank, intent in enumerate(_INTENT_KEYWORDS)}
+
+# Intent -> assistance type stored with the request
+_ASSISTANCE_TYPES = {
+    "immediate_food": "immediate",
+    "scheduled_food": "scheduled",
+    "ngo_referral": "ngo_referral",
+}
+
+
+def _trie_pattern(words) -> str:
+    """
+    Build a regex alternation of words factored into a prefix trie, e.g.
+    ("help", "hungry") -> "h(?:elp|ungry)". The regex engine then tests each
+    character once per position instead of once per keyword, so matching
+    cost stays flat as the keyword lists grow.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: dict) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        if "" in node:
+            return "(?:" + "|".join(branches) + ")?"
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")"
+
+    return build(trie)
+
+
+# Single whole-word scan over every routing keyword
+_INTENT_RE = re.compile(r"\b" + _trie_pattern(_KEYWORD_INTENT) + r"\b", re.IGNORECASE)
+
+
+def classify_intent(text: str) -> str:
+    """Return the highest-priority intent mentioned in text (immediate_food by default)"""
+    best = None
+    for match in _INTENT_RE.finditer(text):
+        intent = _KEYWORD_INTENT[match.group().lower()]
+        if _INTENT_RANK[intent] == 0:
+            return intent
+        if best is None or _INTENT_RANK[intent] < _INTENT_RANK[best]:
+            best = intent
+    # Default to immediate if no clear intent
+    return best or "immediate_food"
 
 
 class ConversationState(TypedDict):
@@ -23,192 +130,166 @@ class ConversationState(TypedDict):
     session_id: str | None
     assistance_type: Literal["immediate", "scheduled", "ngo_referral"] | None
     fulfillment_triggered: bool
+    _last_user_text: str | None  # Latest HumanMessage text, cached by router_node
+    _fields_complete: bool  # All required fields collected, kept up to date by collect_user_info
 
 
 def start_node(state: ConversationState) -> ConversationState:
     """Receive user input and forward to router"""
-    messages = state.get("messages", [])
-    if messages:
-        last_message = messages[-1]
-        if isinstance(last_message, HumanMessage):
-            # Forward message to router
-            return state
     return state
 
 
 def router_node(state: ConversationState) -> ConversationState:
     """Classify intent based on user message"""
     messages = state.get("messages", [])
-    if not messages:
-        return state
-    
-    last_message = messages[-1]
+    last_message = messages[-1] if messages else None
     if not isinstance(last_message, HumanMessage):
+        state["_last_user_text"] = None
         return state
     
-    user_message = last_message.content.lower()
+    user_message = last_message.content.strip()
+    # Cache the stripped text so the assistance nodes don't re-inspect the message list
+    state["_last_user_text"] = user_message
     
-    # Routing rules
-    urgent_keywords = ["hungry", "starving", "need food now", "urgent", "immediate", "emergency", "asap"]
-    scheduled_keywords = ["later", "tomorrow", "next week", "schedule", "plan"]
-    ngo_keywords = ["ngo", "referral", "support", "help", "assistance", "organization"]
-    
-    intent = None
-    if any(keyword in user_message for keyword in urgent_keywords):
-        intent = "immediate_food"
-    elif any(keyword in user_message for keyword in scheduled_keywords):
-        intent = "scheduled_food"
-    elif any(keyword in user_message for keyword in ngo_keywords):
-        intent = "ngo_referral"
-    else:
-        # Default to immediate if no clear intent
-        intent = "immediate_food"
+    intent = classify_intent(user_message)
     
     state["intent"] = intent
-    
-    # Determine assistance type
-    if intent == "immediate_food":
-        state["assistance_type"] = "immediate"
-    elif intent == "scheduled_food":
-        state["assistance_type"] = "scheduled"
-    else:
-        state["assistance_type"] = "ngo_referral"
+    state["assistance_type"] = _ASSISTANCE_TYPES[intent]
     
     return state
 
 
-def immediate_food_node(state: ConversationState) -> ConversationState:
+async def immediate_food_node(state: ConversationState) -> ConversationState:
     """Handle immediate food assistance request"""
-    return collect_user_info(state, "immediate")
+    return await collect_user_info(state, "immediate")
 
 
-def scheduled_food_node(state: ConversationState) -> ConversationState:
+async def scheduled_food_node(state: ConversationState) -> ConversationState:
     """Handle scheduled food assistance request"""
-    return collect_user_info(state, "scheduled")
+    return await collect_user_info(state, "scheduled")
 
 
-def ngo_referral_node(state: ConversationState) -> ConversationState:
+async def ngo_referral_node(state: ConversationState) -> ConversationState:
     """Handle NGO referral request"""
-    return collect_user_info(state, "ngo_referral")
+    return await collect_user_info(state, "ngo_referral")
 
 
-def collect_user_info(state: ConversationState, assistance_type: str) -> ConversationState:
-    """Collect required user information one field at a time"""
-    messages = state.get("messages", [])
-    person_name = state.get("person_name")
-    age = state.get("age")
-    location = state.get("location")
-    food_requirement = state.get("food_requirement")
-    
-    # Check what's missing
-    missing_fields = []
-    if not person_name:
-        missing_fields.append("person_name")
-    if age is None:
-        missing_fields.append("age")
-    if not location:
-        missing_fields.append("location")
-    if not food_requirement:
-        missing_fields.append("food_requirement")
+def extract_name(text: str) -> str | None:
+    """Extract a person's name from stripped user text"""
+    # The patterns capture at most two words with no surrounding whitespace
+    for pattern in _NAME_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            return match.group(1)
     
-    # If all fields collected, trigger fulfillment
-    if not missing_fields:
-        if not state.get("fulfillment_triggered", False):
-            trigger_fulfillment(state, assistance_type)
-            state["fulfillment_triggered"] = True
-            response = "Thank you! Your food assistance request has been confirmed. We're coordinating with our partners to ensure you receive food within 10 minutes. You will receive a confirmation shortly."
-            state["messages"].append(AIMessage(content=response))
-        return state
+    # If message is short, might be just the name
+    words = text.split()
+    if len(words) <= 3 and "".join(words).isalpha():
+        return text
+    return None
+
+
+def extract_age(text: str) -> int | None:
+    """Extract an age between 1 and 120 from user text"""
+    for pattern in _AGE_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            potential_age = int(match.group(1))
+            if 1 <= potential_age <= 120:
+                return potential_age
+    return None
+
+
+def extract_location(text: str) -> str | None:
+    """Extract a location from stripped user text"""
+    for pattern in _LOCATION_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            # Remove common prefixes
+            potential_location = _LOC_PREFIX_RE.sub("", match.group(1))
+            if len(potential_location) > 3:  # Reasonable location length
+                return potential_location
+    return None
+
+
+def extract_food_requirement(text: str) -> str | None:
+    """Treat a longer message as the food requirement"""
+    return text if len(text) > 10 else None
+
+
+# Fields collected one at a time, in order: (state key, extractor, prompt asking for it)
+_FIELD_STEPS = (
+    ("person_name", extract_name,
+     "Hello! I'm here to help you get food assistance. To proceed, I need a few details. Could you please tell me your name?"),
+    ("age", extract_age,
+     "Thank you, {person_name}! Could you please tell me your age?"),
+    ("location", extract_location,
+     "Thank you! Could you please tell me your location or area where you need the food delivered?"),
+    ("food_requirement", extract_food_requirement,
+     "Great! Could you please tell me what kind of food you need or any specific requirements?"),
+)
+
+
+def _next_missing_step(state: ConversationState) -> tuple | None:
+    """Return the _FIELD_STEPS entry for the first field not yet collected"""
+    for step in _FIELD_STEPS:
+        value = state.get(step[0])
+        if value is None or (step[0] != "age" and not value):
+            return step
+    return None
+
+
+async def collect_user_info(state: ConversationState, assistance_type: str) -> ConversationState:
+    """
+    Collect required user information one field at a time. Each pass
+    consumes the latest user message: it fills the field being asked for,
+    then either asks for the next missing field (ending the turn) or, once
+    every field is present, triggers fulfillment.
+    """
+    step = _next_missing_step(state)
     
-    # Extract information from last message if available
-    if messages:
-        last_message = messages[-1]
-        if isinstance(last_message, HumanMessage):
-            user_text = last_message.content.strip()
-            
-            # Try to extract name - improved logic
-            if not person_name:
-                import re
-                # Patterns: "I'm John", "My name is John", "I am John", "name is John", "called John"
-                name_patterns = [
-                    r"(?:i'?m|i am|my name is|name is|called|this is)\s+([A-Z][a-z]+(?:\s+[A-Z][a-z]+)?)",
-                    r"^([A-Z][a-z]+(?:\s+[A-Z][a-z]+)?)$"  # If entire message is just a name
-                ]
-                for pattern in name_patterns:
-                    match = re.search(pattern, user_text, re.IGNORECASE)
-                    if match:
-                        potential_name = match.group(1).strip()
-                        if len(potential_name.split()) <= 3:  # Reasonable name length
-                            person_name = potential_name
-                            state["person_name"] = person_name
-                            break
-                
-                # If still no name and message is short, might be just the name
-                if not person_name and len(user_text.split()) <= 3 and user_text.replace(" ", "").isalpha():
-                    person_name = user_text.strip()
-                    state["person_name"] = person_name
-            
-            # Try to extract age - improved logic
-            if age is None:
-                import re
-                # Patterns: "I am 25", "age is 25", "25 years old", "25"
-                age_patterns = [
-                    r"(?:i am|age is|i'?m|years old|year old)\s+(\d{1,3})",
-                    r"\b(\d{1,3})\s*(?:years?|yrs?|old)?\b",
-                    r"^(\d{1,3})$"  # If entire message is just a number
-                ]
-                for pattern in age_patterns:
-                    match = re.search(pattern, user_text, re.IGNORECASE)
-                    if match:
-                        potential_age = int(match.group(1))
-                        if 1 <= potential_age <= 120:
-                            age = potential_age
-                            state["age"] = age
-                            break
-            
-            # Try to extract location - improved logic
-            if not location:
-                import re
-                # Patterns: "I live in...", "location is...", "address is...", "at...", "in..."
-                location_patterns = [
-                    r"(?:i live in|location is|address is|i am at|i am in|at|in|near|area is|located at)\s+(.+)",
-                    r"^(.+)$"  # If asked for location, entire message might be location
-                ]
-                for pattern in location_patterns:
-                    match = re.search(pattern, user_text, re.IGNORECASE)
-                    if match:
-                        potential_location = match.group(1).strip()
-                        # Remove common prefixes
-                        potential_location = re.sub(r"^(i live in|location is|address is|i am at|i am in|at|in|near|area is|located at)\s+", "", potential_location, flags=re.IGNORECASE)
-                        if len(potential_location) > 3:  # Reasonable location length
-                            location = potential_location
-                            state["location"] = location
-                            break
-            
-            # Try to extract food requirement - if it's a longer message and other fields are filled
-            if not food_requirement and person_name and age is not None and location:
-                # If we have other info and this is a longer message, likely food requirement
-                if len(user_text) > 10:
-                    food_requirement = user_text
-                    state["food_requirement"] = food_requirement
+    # Extract only the field being asked for from the latest user message,
+    # consuming it so it is never extracted from twice
+    user_text = state.get("_last_user_text")
+    state["_last_user_text"] = None
+    if step is not None and user_text is not None:
+        field, extract, _prompt = step
+        value = extract(user_text)
+        if value is not None:
+            state[field] = value
+            step = _next_missing_step(state)
+    state["_fields_complete"] = step is None
     
-    # Ask for missing field (one at a time) - improved prompts
-    if not person_name:
-        response = "Hello! I'm here to help you get food assistance. To proceed, I need a few details. Could you please tell me your name?"
-    elif age is None:
-        response = f"Thank you, {person_name}! Could you please tell me your age?"
-    elif not location:
-        response = f"Thank you! Could you please tell me your location or area where you need the food delivered?"
-    elif not food_requirement:
-        response = "Great! Could you please tell me what kind of food you need or any specific requirements?"
-    else:
-        response = "Thank you for providing all the information!"
+    # Ask for the next missing field; the graph then ends the turn
+    if step is not None:
+        state["messages"].append(AIMessage(content=step[2].format(person_name=state.get("person_name"))))
+        return state
     
-    state["messages"].append(AIMessage(content=response))
+    # All fields collected: trigger fulfillment (once)
+    if not state.get("fulfillment_triggered", False):
+        await trigger_fulfillment(state, assistance_type)
+        state["fulfillment_triggered"] = True
+        response = "Thank you! Your food assistance request has been confirmed. We're coordinating with our partners to ensure you receive food within 10 minutes. You will receive a confirmation shortly."
+        state["messages"].append(AIMessage(content=response))
     return state
 
 
-def trigger_fulfillment(state: ConversationState, assistance_type: str) -> None:
+# Columns of a food_assistance_requests row, in the order _supabase_row fills them
+_SUPABASE_KEYS = (
+    "person_name", "age", "location", "food_request",
+    "assistance_type", "session_id", "created_at", "status"
+)
+
+
+def _supabase_row(person_name, age, location, food_requirement, assistance_type, session_id) -> dict:
+    """Build a pending food_assistance_requests row stamped with the current UTC time"""
+    return dict(zip(_SUPABASE_KEYS, (
+        person_name, age, location, food_requirement, assistance_type, session_id,
+        datetime.now(timezone.utc).isoformat(), "pending"
+    )))
+
+
+async def trigger_fulfillment(state: ConversationState, assistance_type: str) -> None:
     """Trigger fulfillment process when all data is collected"""
     person_name = state.get("person_name")
     age = state.get("age")
@@ -229,65 +310,42 @@ def trigger_fulfillment(state: ConversationState, assistance_type: str) -> None:
     # Store in Supabase
     if supabase:
         try:
-            supabase_data = {
-                "person_name": person_name,
-                "age": age,
-                "location": location,
-                "food_request": food_requirement,
-                "assistance_type": assistance_type,
-                "session_id": session_id,
-                "created_at": datetime.utcnow().isoformat(),
-                "status": "pending"
-            }
+            supabase_data = _supabase_row(
+                person_name, age, location, food_requirement, assistance_type, session_id
+            )
             
-            result = supabase.table("food_assistance_requests").insert(supabase_data).execute()
-            print(f"Data stored in Supabase: {result}")
+            # Hand the row to the background batcher so the reply isn't held up by the insert
+            await supabase_batcher.add(supabase_data)
             
         except Exception as e:
-            print(f"Error storing fulfillment data in Supabase: {e}")
+            logger.error("Error storing fulfillment data in Supabase: %s", e)
             # Continue even if Supabase fails
     else:
-        print(f"Supabase not configured. Fulfillment data (not stored): {fulfillment_data}")
+        logger.info("Supabase not configured. Fulfillment data (not stored): %r", fulfillment_data)
     
     # Trigger fulfillment notification
     try:
-        # Use asyncio to run async function
-        try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        
-        if loop.is_running():
-            # If loop is already running, schedule the coroutine
-            asyncio.create_task(trigger_fulfillment_notification(fulfillment_data))
-        else:
-            loop.run_until_complete(trigger_fulfillment_notification(fulfillment_data))
+        await trigger_fulfillment_notification(fulfillment_data)
     except Exception as e:
-        print(f"Error triggering fulfillment notification: {e}")
+        logger.error("Error triggering fulfillment notification: %s", e)
         # Continue even if notification fails
 
 
 def should_continue(state: ConversationState) -> Literal["collect_info", "end"]:
-    """Determine if we should continue collecting info or end"""
-    person_name = state.get("person_name")
-    age = state.get("age")
-    location = state.get("location")
-    food_requirement = state.get("food_requirement")
-    fulfillment_triggered = state.get("fulfillment_triggered", False)
-    
-    if fulfillment_triggered:
+    """
+    End the turn once the user's message has been consumed (the node has
+    then asked its next question or finished); looping back without new
+    input would only repeat the prompt until GraphRecursionError.
+    """
+    if state.get("fulfillment_triggered") or state.get("_fields_complete") or state.get("_last_user_text") is None:
         return "end"
-    
-    if person_name and age is not None and location and food_requirement:
-        return "end"
-    
     return "collect_info"
 
 
 # Build the graph
+@functools.lru_cache(maxsize=1)
 def create_workflow():
-    """Create the LangGraph workflow"""
+    """Create the LangGraph workflow (compiled once and cached per process)"""
     workflow = StateGraph(ConversationState)
     
     # Add nodes
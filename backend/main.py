@@ -1,17 +1,58 @@
 """
 Main FastAPI application for Zero Hunger Platform
 """
-from fastapi import FastAPI
+from fastapi import BackgroundTasks, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-import os
-from dotenv import load_dotenv
+from fastapi.responses import ORJSONResponse
+import logging
+import logging.handlers
+import queue
+from config import settings
 from database import engine, Base
 from routers import auth, food, referral, ai, analytics, subscription, ngo
 from schemas import ChatRequest, ChatResponse
+from fulfillment import get_client, close_client, batcher
+from supabase_client import close_supabase_client
+
+# Configure logging (set LOG_LEVEL=WARNING in production to skip per-request info logs).
+# Until startup, records are written to stderr directly.
+logging.basicConfig(
+    level=settings.log_level.upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+_log_listener: logging.handlers.QueueListener | None = None
+
+
+def _start_log_listener() -> None:
+    """
+    Route log records through a queue whose listener thread writes them with
+    the root logger's handlers, so request handlers never block on console
+    I/O. Started from the startup hook rather than at import: "python main.py"
+    imports this file twice (as __main__ and as main), and only the app's own
+    hooks know which listener to stop.
+    """
+    global _log_listener
+    if _log_listener is not None:
+        return
+    root = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    # No formatter on the queue handler: it passes the bare message and the
+    # listener's handlers add the prefix once
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    _log_listener.start()
 
-# Load environment variables
-load_dotenv()
+
+def _stop_log_listener() -> None:
+    """Flush queued records and hand the handlers back to the root logger"""
+    global _log_listener
+    if _log_listener is None:
+        return
+    logging.getLogger().handlers = list(_log_listener.handlers)
+    _log_listener.stop()
+    _log_listener = None
 
 # Create database tables
 Base.metadata.create_all(bind=engine)
@@ -20,14 +61,15 @@ Base.metadata.create_all(bind=engine)
 app = FastAPI(
     title="Zero Hunger Platform API",
     description="AI-powered food distribution platform ensuring no one sleeps hungry",
-    version="1.0.0"
+    version="1.0.0",
+    # Serialize responses with orjson instead of the stdlib json module
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware
-CORS_ORIGINS = os.getenv("CORS_ORIGINS", "http://localhost:3000,http://localhost:8000").split(",")
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=CORS_ORIGINS,
+    allow_origins=settings.cors_origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -43,6 +85,25 @@ app.include_router(subscription.router)
 app.include_router(ngo.router)
 
 
+@app.on_event("startup")
+async def startup():
+    """Start the log listener, open the shared fulfillment webhook client and start the background writers"""
+    _start_log_listener()
+    await get_client()
+    batcher.start()
+    ai.insert_batcher.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Store queued requests, flush pending fulfillment batches and close the HTTP clients"""
+    await ai.insert_batcher.stop()
+    await batcher.stop()
+    await close_client()
+    close_supabase_client()
+    _stop_log_listener()
+
+
 @app.api_route("/", methods=["GET", "HEAD"])
 async def root():
     """Root endpoint"""
@@ -61,20 +122,26 @@ async def health_check():
 
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat(chat_request: ChatRequest):
+async def chat(chat_request: ChatRequest, background: BackgroundTasks):
     try:
-        return await ai.chat_with_ai(chat_request)
+        return await ai.chat_with_ai(chat_request, background)
     except Exception as e:
         # Log the error for debugging
-        print(f"Error in /chat endpoint: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in /chat endpoint: %s", e)
         # Catch the error and return a friendly message
         return ChatResponse(reply="Sorry, something went wrong. Please try again.")
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvicorn's default "auto" loop/http pick uvloop + httptools when they are
+    # installed (not on Windows) and fall back to asyncio/h11 otherwise.
+    # Without REDIS_URL chat sessions live in process memory, so keep WORKERS=1.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=settings.workers
+    )
 
 
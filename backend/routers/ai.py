@@ -1,54 +1,136 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, BackgroundTasks
+from fastapi.responses import ORJSONResponse, Response
 from schemas import ChatRequest, ChatResponse
-from supabase_client import supabase
+from supabase_client import supabase, store_rows
 from fulfillment import trigger_fulfillment_notification
+from session_store import session_store
+from workers import BatchQueue
+import logging
+import orjson
 import uuid
 import re
 from datetime import datetime
-from typing import Dict
+from typing import Dict, List
 
 router = APIRouter()
 
-# In-memory session store (in production, use Redis or database)
-sessions: Dict[str, Dict] = {}
+logger = logging.getLogger(__name__)
+
+INSERT_BATCH_SIZE = 100
+INSERT_BATCH_WAIT = 0.05  # seconds
+
+# Extraction patterns, compiled once at import.
+# Name: one pass over the text; an introduction ("I'm John", "my name is John")
+# is tried first at each position, otherwise the whole message may be the name.
+_NAME_RE = re.compile(
+    r"\b(?:i'?m|i am|my name is|name is|called|this is)\s+(?P<intro>[A-Z][a-z]+(?:\s+[A-Z][a-z]+)?)"
+    r"|^(?P<bare>[A-Z][a-z]+(?:\s+[A-Z][a-z]+)?)$",
+    re.IGNORECASE
+)
+# Bare name fallback: one to three words of letters (Unicode letters, like str.isalpha)
+_BARE_NAME_RE = re.compile(r"[^\W\d_]+(?:\s+[^\W\d_]+){0,2}")
+# Age: one pass; a number after "I am"/"age is"/... wins over a bare 1-3 digit number
+_AGE_RE = re.compile(
+    r"\b(?:i am|age is|i'?m|years old|year old)\s+(?P<ctx>\d{1,3})(?!\d)"
+    r"|(?<!\d)(?P<bare>\d{1,3})(?!\d)",
+    re.IGNORECASE
+)
+
+# Opening message: a place ("... in New York") is kept and later confirmed
+# with the user instead of asking for it from scratch. Keywords match in any
+# case; the place is a run of capitalized words that stops at "I"/"I'm" and at
+# sentence punctuation, and it is dropped if any word is clearly not a place
+# ("In Need", "In The Evening", "In Trouble"). Names are not taken from the
+# opening message: "I am Homeless" or "This is Urgent" read exactly like an
+# introduction.
+_OPENING_LOCATION_RE = re.compile(
+    r"\b(?i:i live in|location is|address is|in|at|near|around)\s+"
+    r"(?P<location>(?!I\b)[A-Z][\w'-]*(?:,?\s+(?!I\b)[A-Z][\w'-]*)*)"
+)
+_NOT_A_PLACE = frozenset({
+    "need", "once", "all", "least", "most", "first", "last", "home", "times", "risk",
+    "trouble", "danger", "pain", "distress", "crisis", "morning", "afternoon", "evening",
+    "night", "noon", "today", "tonight", "tomorrow", "day", "week", "weekend", "time",
+    "urgent", "immediate", "emergency", "asap", "my", "your", "our", "this", "that", "some", "any"
+})
+# Answers to "Is that where you need the food delivered?"
+_YES_ANSWERS = frozenset({"y", "yes", "yeah", "yep", "yup", "correct", "right", "sure", "ok", "okay", "that's right"})
+_NO_ANSWERS = frozenset({"n", "no", "nope", "wrong", "not really"})
+
+# Fixed replies, serialized once at import. A response body is the cached
+# prefix plus the JSON-encoded session_id, so no model or serializer runs.
+_CANNED_REPLIES = {
+    "greeting": "Hello! I'm your AI food assistance helper. I'm here to help you get free food within 10 minutes. How can I assist you today?",
+    "prompt_need": "I'm here to help with food assistance. Please let me know if you need food.",
+    "ask_name": "Hello! I'm here to help you get food assistance. To proceed, I need a few details. Could you please tell me your name?",
+    "resume_name": "I'm here to help you get food assistance. Could you please tell me your name?",
+    "age_retry": "I need to know your age. Could you please tell me how old you are? (e.g., 25)",
+    "ask_location": "Thank you! Could you please tell me your location or area where you need the food delivered?",
+    "ask_food": "Great! Could you please tell me what kind of food you need or any specific requirements?",
+    "missing_info": "I'm sorry, some information is missing. Please start a new conversation.",
+    "already_done": "Your request has already been processed. If you need another food assistance request, please start a new conversation.",
+    "error": "I'm sorry, I encountered an error. Please try again or contact support.",
+}
+_CANNED_PREFIXES = {
+    key: orjson.dumps({"reply": text})[:-1] + b',"session_id":'
+    for key, text in _CANNED_REPLIES.items()
+}
+
+def _canned(key: str, session_id: str) -> Response:
+    """Build the response for a fixed reply without going through ChatResponse"""
+    return Response(
+        content=_CANNED_PREFIXES[key] + orjson.dumps(session_id) + b"}",
+        media_type="application/json"
+    )
 
 def extract_name(text: str) -> str | None:
-    """Extract name from user text"""
-    name_patterns = [
-        r"(?:i'?m|i am|my name is|name is|called|this is)\s+([A-Z][a-z]+(?:\s+[A-Z][a-z]+)?)",
-        r"^([A-Z][a-z]+(?:\s+[A-Z][a-z]+)?)$"
-    ]
-    for pattern in name_patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            potential_name = match.group(1).strip()
-            if len(potential_name.split()) <= 3:
-                return potential_name
-    if len(text.split()) <= 3 and text.replace(" ", "").isalpha():
-        return text.strip()
+    """Extract name from user text (expects already-stripped text)"""
+    # Fast path: a single ASCII word ("John") is the name as-is
+    if text.isascii() and text.isalpha():
+        return text
+    match = _NAME_RE.search(text)
+    if match:
+        return match.group("intro") or match.group("bare")
+    if _BARE_NAME_RE.fullmatch(text):
+        return text
     return None
 
 def extract_age(text: str) -> int | None:
-    """Extract age from user text"""
-    age_patterns = [
-        r"(?:i am|age is|i'?m|years old|year old)\s+(\d{1,3})",
-        r"\b(\d{1,3})\s*(?:years?|yrs?|old)?\b",
-        r"^(\d{1,3})$"
-    ]
-    for pattern in age_patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            potential_age = int(match.group(1))
-            if 1 <= potential_age <= 120:
-                return potential_age
+    """Extract age (1-120) from user text"""
+    # Fast path: a bare ASCII number ("25") needs no regex scan
+    if text.isascii() and text.isdigit():
+        if len(text) > 3:
+            return None
+        age = int(text)
+        return age if 1 <= age <= 120 else None
+    bare_age = None
+    for match in _AGE_RE.finditer(text):
+        ctx = match.group("ctx")
+        potential_age = int(ctx or match.group("bare"))
+        if not 1 <= potential_age <= 120:
+            continue
+        if ctx:
+            return potential_age
+        if bare_age is None:
+            bare_age = potential_age
+    return bare_age
+
+def extract_opening_location(text: str) -> str | None:
+    """Return the place mentioned in the user's first message, if any"""
+    for match in _OPENING_LOCATION_RE.finditer(text):
+        location = match.group("location")
+        if not any(word.rstrip(",").lower() in _NOT_A_PLACE for word in location.split()):
+            return location
     return None
 
-async def store_in_supabase(session_data: Dict, session_id: str) -> bool:
-    """Store food assistance request in Supabase"""
+def build_supabase_row(session_data: Dict, session_id: str) -> Dict | None:
+    """
+    Validate a completed session and build its food_assistance_requests row.
+    Returns None if Supabase isn't configured or required fields are missing.
+    """
     if not supabase:
-        print("⚠️ Supabase not configured. Skipping database storage.")
-        print("   Please set SUPABASE_URL and SUPABASE_KEY in your .env file")
-        return False
+        logger.warning("Supabase not configured (set SUPABASE_URL and SUPABASE_KEY). Skipping database storage.")
+        return None
     
     # Validate required fields
     person_name = session_data.get("person_name")
@@ -57,276 +139,254 @@ async def store_in_supabase(session_data: Dict, session_id: str) -> bool:
     food_requirement = session_data.get("food_requirement", "General food assistance")
     
     if not person_name or not age or not location:
-        print(f"❌ Missing required fields. Name: {person_name}, Age: {age}, Location: {location}")
-        return False
+        logger.error("Missing required fields. Name: %s, Age: %s, Location: %s", person_name, age, location)
+        return None
     
-    try:
-        supabase_data = {
-            "person_name": person_name,
-            "age": age,
-            "location": location,
-            "food_request": food_requirement,
-            "assistance_type": session_data.get("assistance_type", "immediate"),
-            "session_id": session_id,
-            "status": "pending"
-        }
-        
-        print(f"📤 Attempting to store data in Supabase: {supabase_data}")
-        
-        result = supabase.table("food_assistance_requests").insert(supabase_data).execute()
-        
-        if result.data:
-            print(f"✅ Data stored in Supabase successfully!")
-            print(f"   Record ID: {result.data[0].get('id', 'N/A')}")
-            print(f"   Person: {person_name}, Age: {age}, Location: {location}")
-            return True
-        else:
-            print(f"⚠️ Supabase insert returned no data")
-            return False
-            
-    except Exception as e:
-        print(f"❌ Error storing data in Supabase: {e}")
-        print(f"   Error type: {type(e).__name__}")
-        import traceback
-        traceback.print_exc()
-        return False
+    return {
+        "person_name": person_name,
+        "age": age,
+        "location": location,
+        "food_request": food_requirement,
+        "assistance_type": session_data.get("assistance_type", "immediate"),
+        "session_id": session_id,
+        "status": "pending"
+    }
 
-@router.post("/chat", response_model=ChatResponse)
-async def chat_with_ai(chat_request: ChatRequest):
+async def store_in_supabase(row: Dict) -> None:
+    """
+    Queue a row for storage in Supabase (waits while the queue is full).
+    Rows are bulk-inserted by insert_batcher, which then triggers the
+    fulfillment webhook for every stored row.
+    """
+    logger.debug("Queueing data for Supabase: %r", row)
+    await insert_batcher.add(row)
+
+def _fulfillment_data(row: Dict) -> Dict:
+    """Map a stored food_assistance_requests row to the fulfillment payload"""
+    return {
+        "person_name": row["person_name"],
+        "age": row["age"],
+        "location": row["location"],
+        "food_requirement": row["food_request"],
+        "assistance_type": row["assistance_type"],
+        "session_id": row["session_id"]
+    }
+
+async def _insert_and_notify(rows: List[Dict]) -> None:
+    """Bulk-insert rows into Supabase, then trigger the webhook for each stored row"""
+    stored = await store_rows(rows)
+    
+    # Trigger webhook AFTER successful storage. This only queues each payload
+    # on the fulfillment batcher, so a plain loop is as fast as anything else.
+    for row in stored:
+        try:
+            await trigger_fulfillment_notification(_fulfillment_data(row))
+        except Exception as e:
+            logger.warning("Webhook notification failed: %s", e)
+
+# Completed requests waiting to be bulk-inserted into Supabase, one batch at a time
+insert_batcher = BatchQueue(_insert_and_notify, INSERT_BATCH_SIZE, INSERT_BATCH_WAIT, maxsize=1000)
+
+async def _h_start(session: Dict, msg: str, session_id: str, background: BackgroundTasks) -> ChatResponse | Response:
+    # If user sent any non-empty message, proceed to ask for name
+    # This prevents the loop of asking "please let me know if you need food"
+    if msg:
+        # Keep a location given up front so we don't ask for it again
+        location = extract_opening_location(msg)
+        if location:
+            session["location"] = location
+        session["step"] = "asking_name"  # CRITICAL: Advance step to prevent loop
+        logger.debug("Step advanced: start -> asking_name, Location: %s", location)
+        return _canned("ask_name", session_id)
+    else:
+        # Only ask again if message is truly empty
+        return _canned("prompt_need", session_id)
+
+async def _h_name(session: Dict, msg: str, session_id: str, background: BackgroundTasks) -> ChatResponse | Response:
+    # CRITICAL: Accept ANY input (even empty) to prevent infinite loops
+    # If we're in asking_name step, any message should be treated as a name
+    if msg:
+        # Accept the input as-is if extraction fails
+        name = extract_name(msg) or msg
+    else:
+        # Even if empty, assign a default to prevent loop
+        name = "User"
+    session["person_name"] = name
+    
+    # ALWAYS advance step - this is critical to prevent loops
+    session["step"] = "asking_age"
+    logger.debug("Step advanced: asking_name -> asking_age, Name: %s", name)
+    return ChatResponse(
+        reply=f"Thank you, {name}! Could you please tell me your age?",
+        session_id=session_id
+    )
+
+def _after_age(session: Dict, session_id: str) -> ChatResponse | Response:
+    """Move on from the age step, confirming a location picked up from the opening message"""
+    location = session.get("location")
+    if location:
+        session["step"] = "confirming_location"
+        return ChatResponse(
+            reply=f"Thank you! You mentioned {location}. Is that where you need the food delivered? Reply yes, or tell me the right location.",
+            session_id=session_id
+        )
+    session["step"] = "asking_location"
+    return _canned("ask_location", session_id)
+
+async def _h_age(session: Dict, msg: str, session_id: str, background: BackgroundTasks) -> ChatResponse | Response:
+    age = extract_age(msg)
+    if age is not None:
+        session["age"] = age
+        logger.debug("Age step done, Age: %s", age)
+        return _after_age(session, session_id)
+    
+    # Track attempts to prevent infinite loop
+    if "_age_attempts" not in session:
+        session["_age_attempts"] = 0
+    session["_age_attempts"] += 1
+    
+    # After 2 attempts, use a default age and move on
+    if session["_age_attempts"] >= 2:
+        session["age"] = 25  # Default age
+        logger.debug(
+            "Age attempts exceeded (%s), using age %s, moving on",
+            session["_age_attempts"], session["age"]
+        )
+        return _after_age(session, session_id)
+    
+    return _canned("age_retry", session_id)
+
+async def _h_location(session: Dict, msg: str, session_id: str, background: BackgroundTasks) -> ChatResponse | Response:
+    # Accept any input as location to prevent loops
+    if msg:
+        session["location"] = msg
+        session["step"] = "asking_food_requirement"
+        logger.debug("Step advanced: asking_location -> asking_food_requirement, Location: %s", session["location"])
+        return _canned("ask_food", session_id)
+    else:
+        # Even if empty, use a default and advance to prevent loop
+        session["location"] = "Not specified"
+        session["step"] = "asking_food_requirement"
+        logger.debug("Empty location, using default, advancing to food_requirement")
+        return _canned("ask_food", session_id)
+
+async def _h_confirm_location(session: Dict, msg: str, session_id: str, background: BackgroundTasks) -> ChatResponse | Response:
+    answer = msg.lower().rstrip(".!")
+    if answer in _NO_ANSWERS:
+        session["location"] = None
+        session["step"] = "asking_location"
+        return _canned("ask_location", session_id)
+    # An empty reply or a yes keeps the location; anything else is the corrected location
+    if msg and answer not in _YES_ANSWERS:
+        session["location"] = msg
+    session["step"] = "asking_food_requirement"
+    logger.debug("Location confirmed, advancing to food_requirement, Location: %s", session["location"])
+    return _canned("ask_food", session_id)
+
+async def _h_food(session: Dict, msg: str, session_id: str, background: BackgroundTasks) -> ChatResponse | Response:
+    # Accept any response as food requirement
+    food_requirement = session["food_requirement"] = msg if msg else "General food assistance"
+    session["step"] = "completed"
+    name, age, location = session["person_name"], session["age"], session["location"]
+    
+    # Validate all required data is present before storing
+    if not name or age is None or not location:
+        logger.error(
+            "Validation failed: missing required fields. Name: %s, Age: %s, Location: %s",
+            name, age, location
+        )
+        return _canned("missing_info", session_id)
+    
+    logger.info(
+        "Storing food assistance request for session %s: name=%s, age=%s, location=%s, food=%r, type=%s",
+        session_id, name, age, location, food_requirement, session["assistance_type"]
+    )
+    
+    # Reply right away; the row is queued for storage after the response is
+    # sent, and the webhook fires once it has been stored
+    row = build_supabase_row(session, session_id)
+    if row is not None:
+        background.add_task(store_in_supabase, row)
+    
+    # Prepare completion message
+    response_text = f"Thank you {name}! Your food assistance request has been confirmed. We're coordinating with our partners to ensure you receive food within 10 minutes. You will receive a confirmation shortly."
+    
+    if row is not None:
+        response_text += " ✅ Your request has been received."
+    else:
+        response_text += " ⚠️ Note: There was an issue saving your request. Please contact support."
+    
+    return ChatResponse(reply=response_text, session_id=session_id)
+
+async def _h_completed(session: Dict, msg: str, session_id: str, background: BackgroundTasks) -> ChatResponse | Response:
+    return _canned("already_done", session_id)
+
+async def _h_unknown(session: Dict, msg: str, session_id: str, background: BackgroundTasks) -> ChatResponse | Response:
+    # Fallback - unknown step, log and try to recover
+    logger.warning("Unknown step %r for session %s...", session["step"], session_id[:8])
+    # Don't reset to start, try to continue from current state
+    session["step"] = "asking_name"  # Try to continue the flow
+    return _canned("resume_name", session_id)
+
+# Conversation step -> handler for the user's reply at that step
+_HANDLERS = {
+    "start": _h_start,
+    "asking_name": _h_name,
+    "asking_age": _h_age,
+    "asking_location": _h_location,
+    "confirming_location": _h_confirm_location,
+    "asking_food_requirement": _h_food,
+    "completed": _h_completed,
+}
+
+@router.post("/chat", response_model=ChatResponse, response_class=ORJSONResponse)
+async def chat_with_ai(chat_request: ChatRequest, background: BackgroundTasks):
     """
     Chat endpoint with session-based state tracking and Supabase storage
     """
+    # Stripped once here; handlers receive it as-is and must not re-strip
     user_msg_original = (chat_request.message or "").strip()
-    user_msg = user_msg_original.lower().strip()
+    
+    # Init ping from a new client: greet without touching the session store.
+    # The session is created on the first real message, which starts at the
+    # "start" step just as if it had been created here.
+    if not user_msg_original and not chat_request.session_id:
+        return _canned("greeting", uuid.uuid4().hex)
     
     # Get or create session_id
-    session_id = chat_request.session_id
-    if not session_id:
-        session_id = str(uuid.uuid4())
+    session_id = chat_request.session_id or uuid.uuid4().hex
     
+    session = None
     try:
-        # Initialize session if it doesn't exist
-        is_new_session = session_id not in sessions
+        # Load the session, initializing it if it doesn't exist
+        session, is_new_session = await session_store.get_or_create(session_id)
         
         if is_new_session:
-            sessions[session_id] = {
-                "step": "start",
-                "person_name": None,
-                "age": None,
-                "location": None,
-                "food_requirement": None,
-                "assistance_type": "immediate"
-            }
             # Only send greeting if user sent an empty message (initialization)
-            if not user_msg_original or user_msg_original == "":
-                return ChatResponse(
-                    reply="Hello! I'm your AI food assistance helper. I'm here to help you get free food within 10 minutes. How can I assist you today?",
-                    session_id=session_id
-                )
+            if not user_msg_original:
+                return _canned("greeting", session_id)
             # If user sent a message on first request, continue processing below
         
-        session = sessions[session_id]
-        
-        # Ensure session has required keys
-        if "step" not in session:
-            session["step"] = "start"
-        if "person_name" not in session:
-            session["person_name"] = None
-        if "age" not in session:
-            session["age"] = None
-        if "location" not in session:
-            session["location"] = None
-        
-        # Debug logging
-        print(f"🔍 Session: {session_id[:8]}..., Step: {session['step']}, Message: '{user_msg_original[:50]}'")
-        print(f"   Current session state: name={session.get('person_name')}, age={session.get('age')}, location={session.get('location')}")
-        
-        # Process based on current step
-        if session["step"] == "start":
-            # If user sent any non-empty message, proceed to ask for name
-            # This prevents the loop of asking "please let me know if you need food"
-            if user_msg_original and len(user_msg_original.strip()) > 0:
-                session["step"] = "asking_name"  # CRITICAL: Advance step to prevent loop
-                print(f"✅ Step advanced: start → asking_name")
-                return ChatResponse(
-                    reply="Hello! I'm here to help you get food assistance. To proceed, I need a few details. Could you please tell me your name?",
-                    session_id=session_id
-                )
-            else:
-                # Only ask again if message is truly empty
-                return ChatResponse(
-                    reply="I'm here to help with food assistance. Please let me know if you need food.",
-                    session_id=session_id
-                )
-        
-        elif session["step"] == "asking_name":
-            # CRITICAL: Accept ANY input (even empty) to prevent infinite loops
-            # If we're in asking_name step, any message should be treated as a name
-            if user_msg_original and len(user_msg_original.strip()) > 0:
-                name = extract_name(user_msg_original)
-                if name:
-                    session["person_name"] = name
-                else:
-                    # Accept the input as-is if extraction fails
-                    session["person_name"] = user_msg_original.strip()
-            else:
-                # Even if empty, assign a default to prevent loop
-                session["person_name"] = "User"
-            
-            # ALWAYS advance step - this is critical to prevent loops
-            session["step"] = "asking_age"
-            print(f"✅ Step advanced: asking_name → asking_age, Name: {session['person_name']}")
-            return ChatResponse(
-                reply=f"Thank you, {session['person_name']}! Could you please tell me your age?",
-                session_id=session_id
+        # Debug logging (skipped entirely unless DEBUG is enabled)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Session %s..., Step: %s, Message: %r, name=%s, age=%s, location=%s",
+                session_id[:8], session["step"], user_msg_original[:50],
+                session.get("person_name"), session.get("age"), session.get("location")
             )
         
-        elif session["step"] == "asking_age":
-            age = extract_age(user_msg)
-            if age is not None:
-                session["age"] = age
-                session["step"] = "asking_location"
-                print(f"✅ Step advanced: asking_age → asking_location, Age: {age}")
-                return ChatResponse(
-                    reply="Thank you! Could you please tell me your location or area where you need the food delivered?",
-                    session_id=session_id
-                )
-            else:
-                # Try to extract number from message
-                numbers = re.findall(r'\d+', user_msg)
-                if numbers:
-                    potential_age = int(numbers[0])
-                    if 1 <= potential_age <= 120:
-                        session["age"] = potential_age
-                        session["step"] = "asking_location"
-                        print(f"✅ Step advanced: asking_age → asking_location, Age: {potential_age}")
-                        return ChatResponse(
-                            reply="Thank you! Could you please tell me your location or area where you need the food delivered?",
-                            session_id=session_id
-                        )
-                
-                # Track attempts to prevent infinite loop
-                if "_age_attempts" not in session:
-                    session["_age_attempts"] = 0
-                session["_age_attempts"] += 1
-                
-                # After 2 attempts, accept any number or default and move on
-                if session["_age_attempts"] >= 2:
-                    # Try to get any number from the message
-                    if numbers:
-                        session["age"] = int(numbers[0]) if 1 <= int(numbers[0]) <= 120 else 25
-                    else:
-                        session["age"] = 25  # Default age
-                    session["step"] = "asking_location"
-                    print(f"⚠️ Age attempts exceeded ({session['_age_attempts']}), using age {session['age']}, advancing to location")
-                    return ChatResponse(
-                        reply="Thank you! Could you please tell me your location or area where you need the food delivered?",
-                        session_id=session_id
-                    )
-                
-                return ChatResponse(
-                    reply="I need to know your age. Could you please tell me how old you are? (e.g., 25)",
-                    session_id=session_id
-                )
-        
-        elif session["step"] == "asking_location":
-            # Accept any input as location to prevent loops
-            if user_msg_original and len(user_msg_original.strip()) > 0:
-                session["location"] = user_msg_original.strip()
-                session["step"] = "asking_food_requirement"
-                print(f"✅ Step advanced: asking_location → asking_food_requirement, Location: {session['location']}")
-                return ChatResponse(
-                    reply="Great! Could you please tell me what kind of food you need or any specific requirements?",
-                    session_id=session_id
-                )
-            else:
-                # Even if empty, use a default and advance to prevent loop
-                session["location"] = "Not specified"
-                session["step"] = "asking_food_requirement"
-                print(f"⚠️ Empty location, using default, advancing to food_requirement")
-                return ChatResponse(
-                    reply="Great! Could you please tell me what kind of food you need or any specific requirements?",
-                    session_id=session_id
-                )
-        
-        elif session["step"] == "asking_food_requirement":
-            # Accept any response as food requirement
-            session["food_requirement"] = user_msg_original if user_msg_original else "General food assistance"
-            session["step"] = "completed"
-            
-            # Validate all required data is present before storing
-            if not session.get("person_name") or session.get("age") is None or not session.get("location"):
-                print(f"❌ Validation failed: Missing required fields")
-                print(f"   Name: {session.get('person_name')}, Age: {session.get('age')}, Location: {session.get('location')}")
-                return ChatResponse(
-                    reply="I'm sorry, some information is missing. Please start a new conversation.",
-                    session_id=session_id
-                )
-            
-            # Log the data that will be stored
-            print(f"\n{'='*60}")
-            print(f"📝 Preparing to store food assistance request to Supabase...")
-            print(f"   Session ID: {session_id}")
-            print(f"   Name: {session['person_name']}")
-            print(f"   Age: {session['age']}")
-            print(f"   Location: {session['location']}")
-            print(f"   Food Requirement: {session['food_requirement']}")
-            print(f"   Assistance Type: {session['assistance_type']}")
-            print(f"{'='*60}\n")
-            
-            # Store in Supabase FIRST (before webhook)
-            stored = await store_in_supabase(session, session_id)
-            
-            # Trigger webhook AFTER successful storage (if stored)
-            fulfillment_data = {
-                "person_name": session["person_name"],
-                "age": session["age"],
-                "location": session["location"],
-                "food_requirement": session["food_requirement"],
-                "assistance_type": session["assistance_type"],
-                "session_id": session_id
-            }
-            
-            if stored:
-                try:
-                    await trigger_fulfillment_notification(fulfillment_data)
-                    print(f"✅ Webhook notification sent successfully")
-                except Exception as e:
-                    print(f"⚠️ Webhook notification failed: {e}")
-            
-            # Prepare completion message
-            response_text = f"Thank you {session['person_name']}! Your food assistance request has been confirmed. We're coordinating with our partners to ensure you receive food within 10 minutes. You will receive a confirmation shortly."
-            
-            if stored:
-                response_text += " ✅ Your request has been saved in our system."
-            else:
-                response_text += " ⚠️ Note: There was an issue saving your request. Please contact support."
-            
-            return ChatResponse(reply=response_text, session_id=session_id)
-        
-        elif session["step"] == "completed":
-            return ChatResponse(
-                reply="Your request has already been processed. If you need another food assistance request, please start a new conversation.",
-                session_id=session_id
-            )
-        
-        else:
-            # Fallback - unknown step, log and try to recover
-            print(f"⚠️ Unknown step '{session['step']}' for session {session_id[:8]}...")
-            # Don't reset to start, try to continue from current state
-            session["step"] = "asking_name"  # Try to continue the flow
-            return ChatResponse(
-                reply="I'm here to help you get food assistance. Could you please tell me your name?",
-                session_id=session_id
-            )
+        # Process based on current step
+        handler = _HANDLERS.get(session["step"], _h_unknown)
+        return await handler(session, user_msg_original, session_id, background)
     
     except Exception as e:
-        error_msg = str(e)
-        error_type = type(e).__name__
-        print(f"❌ Error in chat_with_ai ({error_type}): {error_msg}")
-        import traceback
-        traceback.print_exc()
-        return ChatResponse(
-            reply="I'm sorry, I encountered an error. Please try again or contact support.",
-            session_id=session_id
-        )
+        logger.exception("Error in chat_with_ai (%s): %s", type(e).__name__, e)
+        return _canned("error", session_id)
+    finally:
+        # Persist whatever step/fields this turn changed. A failed save must
+        # not turn an answered turn into a 500; the user just repeats a step.
+        if session is not None:
+            try:
+                await session_store.save(session_id, session)
+            except Exception:
+                logger.exception("Could not save session %s...", session_id[:8])
@@ -2,7 +2,8 @@ from pydantic import BaseModel
 from typing import Optional
 
 class ChatRequest(BaseModel):
-    message: str
+    # Optional so clients can open a session with a bare init ping
+    message: Optional[str] = None
     session_id: Optional[str] = None
 
 class ChatResponse(BaseModel):
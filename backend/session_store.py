@@ -0,0 +1,119 @@
+"""
+Chat session storage for the /chat endpoint.
+
+Sessions live in Redis (one hash per session, expiring after SESSION_TTL_SECONDS)
+when REDIS_URL is set, so several uvicorn workers can share them. Without Redis
+they are kept in process memory, which only works with a single worker; the
+in-memory store is bounded and drops sessions idle for longer than the TTL.
+"""
+import logging
+from typing import Any, Dict, Tuple
+from cachetools import TTLCache
+from redis.asyncio import Redis
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Fields every session starts with
+SESSION_DEFAULTS: Dict[str, Any] = {
+    "step": "start",
+    "person_name": None,
+    "age": None,
+    "location": None,
+    "food_requirement": None,
+    "assistance_type": "immediate"
+}
+
+# Session fields stored as integers (Redis hashes only hold strings)
+_INT_FIELDS = ("age", "_age_attempts")
+
+
+def _decode_session(raw: Dict[str, str]) -> Dict[str, Any]:
+    """Rebuild a session dict from a Redis hash, filling defaults and restoring ints"""
+    session = dict(SESSION_DEFAULTS)
+    session.update(raw)
+    for field in _INT_FIELDS:
+        if session.get(field) is not None:
+            session[field] = int(session[field])
+    return session
+
+
+# Upper bound on sessions held by the in-memory store
+MEMORY_MAX_SESSIONS = 100_000
+
+
+class MemorySessionStore:
+    """
+    Per-process session store. Sessions expire ttl_seconds after their last
+    save and the least recently used ones are evicted beyond max_sessions.
+    No lock is needed: it is only touched from the event loop thread.
+    """
+
+    def __init__(self, ttl_seconds: int, max_sessions: int = MEMORY_MAX_SESSIONS):
+        self._sessions: TTLCache = TTLCache(maxsize=max_sessions, ttl=ttl_seconds)
+
+    async def get_or_create(self, session_id: str) -> Tuple[Dict[str, Any], bool]:
+        """Return (session, is_new), creating the session with defaults if needed"""
+        session = self._sessions.get(session_id)
+        if session is not None:
+            return session, False
+        session = self._sessions[session_id] = dict(SESSION_DEFAULTS)
+        return session, True
+
+    async def save(self, session_id: str, session: Dict[str, Any]) -> None:
+        self._sessions[session_id] = session
+
+
+class RedisSessionStore:
+    """Session store backed by Redis hashes with a sliding TTL"""
+
+    def __init__(self, client: Redis, ttl_seconds: int):
+        self._redis = client
+        self._ttl = ttl_seconds
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"sess:{session_id}"
+
+    async def get_or_create(self, session_id: str) -> Tuple[Dict[str, Any], bool]:
+        """Return (session, is_new), creating the session with defaults if needed"""
+        key = self._key(session_id)
+        # HSETNX claims the session atomically; HGETALL reads it in the same round trip
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hsetnx(key, "step", SESSION_DEFAULTS["step"])
+            pipe.hgetall(key)
+            pipe.expire(key, self._ttl)
+            created, raw, _ = await pipe.execute()
+        if created:
+            session = dict(SESSION_DEFAULTS)
+            await self.save(session_id, session)
+            return session, True
+        return _decode_session(raw), False
+
+    async def save(self, session_id: str, session: Dict[str, Any]) -> None:
+        """Write the session back, dropping fields that are None, and refresh its TTL"""
+        key = self._key(session_id)
+        mapping = {field: value for field, value in session.items() if value is not None}
+        cleared = [field for field, value in session.items() if value is None]
+        async with self._redis.pipeline(transaction=True) as pipe:
+            if mapping:
+                pipe.hset(key, mapping=mapping)
+            if cleared:
+                pipe.hdel(key, *cleared)
+            pipe.expire(key, self._ttl)
+            await pipe.execute()
+
+
+def _create_session_store():
+    # from_url() does not connect, so an unreachable server is not detected
+    # here; it surfaces as logged errors on the first /chat requests. There is
+    # deliberately no fallback to memory, which would split sessions between
+    # workers.
+    if settings.redis_url:
+        client = Redis.from_url(settings.redis_url, decode_responses=True)
+        logger.info("Using Redis session store")
+        return RedisSessionStore(client, settings.session_ttl_seconds)
+    return MemorySessionStore(settings.session_ttl_seconds)
+
+
+session_store = _create_session_store()
@@ -1,24 +1,115 @@
 """
 Supabase client configuration
 """
-from supabase import create_client, Client
-import os
-from dotenv import load_dotenv
-from typing import Optional
+import asyncio
+import httpx
+import logging
+from postgrest.exceptions import APIError
+from supabase import create_client, Client, ClientOptions
+from typing import Dict, List, Optional
+from config import settings
+from workers import backoff_delay
 
-load_dotenv()
+logger = logging.getLogger(__name__)
+
+SUPABASE_URL = settings.supabase_url
+SUPABASE_KEY = settings.supabase_key
+
+INSERT_MAX_ATTEMPTS = 3
+
+# PostgREST errors after which the statement certainly did not run (or was
+# rolled back) and may succeed later: database unreachable, no free pool
+# connection, serialization failure, deadlock, statement timeout, too many
+# connections
+_RETRYABLE_API_CODES = frozenset({"PGRST000", "PGRST001", "PGRST002", "PGRST003", "40001", "40P01", "57014", "53300"})
+
+
+def is_retryable_error(exc: Exception) -> bool:
+    """
+    True if a failed Supabase write can safely be retried. Constraint
+    violations and other API errors are permanent. Of the network errors,
+    only those raised before the request was sent are retried; a read
+    timeout may hit a write the server already committed, and retrying it
+    would insert duplicates.
+    """
+    if isinstance(exc, APIError):
+        return exc.code in _RETRYABLE_API_CODES
+    return isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
 # Make Supabase optional for development/testing
 supabase: Optional[Client] = None
+_http_client: Optional[httpx.Client] = None
 if SUPABASE_URL and SUPABASE_KEY:
     try:
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+        # Pooled HTTP/2 client shared by all Supabase requests, so inserts reuse a
+        # kept-alive connection instead of paying a TCP + TLS handshake each time.
+        # It is synchronous because supabase-py calls run in worker threads.
+        _http_client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60.0),
+            timeout=10.0
+        )
+        supabase = create_client(
+            SUPABASE_URL,
+            SUPABASE_KEY,
+            options=ClientOptions(httpx_client=_http_client)
+        )
         print("Supabase client initialized successfully")
     except Exception as e:
         print(f"Warning: Could not initialize Supabase client: {e}")
         supabase = None
+        if _http_client is not None:
+            _http_client.close()
+            _http_client = None
 else:
     print("Warning: SUPABASE_URL and SUPABASE_KEY not set. Supabase features will be disabled.")
+
+
+def close_supabase_client() -> None:
+    """Close the pooled Supabase HTTP client (called on application shutdown)"""
+    global _http_client
+    if _http_client is not None:
+        _http_client.close()
+        _http_client = None
+
+
+async def _insert_rows(rows: List[Dict]) -> None:
+    """Insert rows in one request, retrying errors that are safe to retry; re-raises the last error"""
+    for attempt in range(INSERT_MAX_ATTEMPTS):
+        try:
+            # supabase-py is synchronous; run the insert in a worker thread so the event loop stays free
+            await asyncio.to_thread(
+                lambda: supabase.table("food_assistance_requests").insert(rows).execute()
+            )
+            return
+        except Exception as e:
+            if not is_retryable_error(e) or attempt == INSERT_MAX_ATTEMPTS - 1:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning("Error storing %d row(s) in Supabase, retrying in %.1fs: %s", len(rows), delay, e)
+            await asyncio.sleep(delay)
+
+
+async def store_rows(rows: List[Dict]) -> List[Dict]:
+    """Bulk-insert food_assistance_requests rows and return the ones that were stored"""
+    try:
+        await _insert_rows(rows)
+        stored = rows
+    except Exception as e:
+        # A rejected bulk insert is rolled back as a whole; store the valid
+        # rows one by one. Anything else (e.g. a read timeout) may already be
+        # committed, so it is not replayed.
+        if len(rows) == 1 or not isinstance(e, APIError) or is_retryable_error(e):
+            logger.error("Error storing %d row(s) in Supabase, giving up: %s; rows: %r", len(rows), e, rows)
+            return []
+        logger.warning("Supabase rejected a batch of %d row(s) (%s), inserting them one by one", len(rows), e)
+        stored = []
+        for row in rows:
+            try:
+                await _insert_rows([row])
+                stored.append(row)
+            except Exception as row_error:
+                logger.error("Error storing row in Supabase, giving up: %s; row: %r", row_error, row)
+    logger.info("Stored %d row(s) in Supabase", len(stored))
+    return stored
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from routers.ai import _h_age, _h_confirm_location, _h_start, extract_opening_location
+from session_store import SESSION_DEFAULTS
+
+
+@pytest.mark.parametrize("text", [
+    "I am Homeless and need food",
+    "I'm Starving",
+    "This is Urgent",
+    "I am In Need",
+    "I need food At Once",
+    "I need food In The Evening",
+    "Help, I am in Trouble",
+    "hi",
+])
+def test_no_location_in_opening(text):
+    assert extract_opening_location(text) is None
+
+
+@pytest.mark.parametrize("text, location", [
+    ("I need food now in Brooklyn", "Brooklyn"),
+    ("I'm In Brooklyn", "Brooklyn"),
+    ("I live in Austin, Texas", "Austin, Texas"),
+    ("near The Bronx", "The Bronx"),
+    ("In Brooklyn I need food", "Brooklyn"),
+    ("I live in Austin I'm hungry", "Austin"),
+    ("I'm in Brooklyn. I need food", "Brooklyn"),
+])
+def test_location_in_opening(text, location):
+    assert extract_opening_location(text) == location
+
+
+@pytest.mark.parametrize("text", [
+    "I am Homeless and need food",
+    "I'm Starving",
+    "This is Urgent",
+    "I'm In Brooklyn",
+])
+def test_start_always_asks_for_name(text):
+    session = dict(SESSION_DEFAULTS)
+    asyncio.run(_h_start(session, text, "test-session", None))
+    assert session["person_name"] is None
+    assert session["step"] == "asking_name"
+
+
+def test_start_keeps_opening_location():
+    session = dict(SESSION_DEFAULTS)
+    asyncio.run(_h_start(session, "I need food now in Brooklyn", "test-session", None))
+    assert session["location"] == "Brooklyn"
+    assert session["step"] == "asking_name"
+
+
+def _session_at_age_step(location):
+    session = dict(SESSION_DEFAULTS, step="asking_age", person_name="John", location=location)
+    asyncio.run(_h_age(session, "25", "test-session", None))
+    return session
+
+
+def test_prefilled_location_is_confirmed_not_skipped():
+    session = _session_at_age_step("Brooklyn")
+    assert session["step"] == "confirming_location"
+
+
+@pytest.mark.parametrize("answer, step, location", [
+    ("yes", "asking_food_requirement", "Brooklyn"),
+    ("Yes!", "asking_food_requirement", "Brooklyn"),
+    ("no", "asking_location", None),
+    ("Queens, NY", "asking_food_requirement", "Queens, NY"),
+])
+def test_confirm_location_answers(answer, step, location):
+    session = _session_at_age_step("Brooklyn")
+    asyncio.run(_h_confirm_location(session, answer, "test-session", None))
+    assert session["step"] == step
+    assert session["location"] == location
+
+
+def test_no_prefilled_location_asks_for_it():
+    session = _session_at_age_step(None)
+    assert session["step"] == "asking_location"
@@ -0,0 +1,89 @@
+import asyncio
+
+from workers import BatchQueue
+
+
+def _collector():
+    handled = []
+
+    async def handler(batch):
+        handled.extend(batch)
+
+    return handled, handler
+
+
+def test_stop_with_items_just_queued():
+    handled, handler = _collector()
+
+    async def scenario():
+        queue = BatchQueue(handler, 50, 0.2, max_concurrency=64)
+        for i in range(3):
+            await queue.add(i)
+        await asyncio.sleep(0)
+        await asyncio.wait_for(queue.stop(timeout=5), 10)
+
+    asyncio.run(scenario())
+    assert sorted(handled) == [0, 1, 2]
+
+
+def test_stop_while_collecting_a_batch():
+    handled, handler = _collector()
+
+    async def scenario():
+        queue = BatchQueue(handler, 50, 0.2, max_concurrency=64)
+        queue.start()
+        await asyncio.sleep(0.01)
+        for i in range(3):
+            await queue.add(i)
+        await asyncio.sleep(0.01)
+        await asyncio.wait_for(queue.stop(timeout=5), 10)
+
+    asyncio.run(scenario())
+    assert sorted(handled) == [0, 1, 2]
+
+
+def test_stop_with_full_bounded_queue():
+    handled = []
+
+    async def slow_handler(batch):
+        await asyncio.sleep(0.1)
+        handled.extend(batch)
+
+    async def scenario():
+        queue = BatchQueue(slow_handler, 2, 0.01, maxsize=2)
+        for i in range(6):
+            await queue.add(i)
+        await asyncio.wait_for(queue.stop(timeout=5), 10)
+
+    asyncio.run(scenario())
+    assert sorted(handled) == list(range(6))
+
+
+def test_stop_times_out_on_stuck_handler():
+    async def stuck_handler(batch):
+        await asyncio.sleep(3600)
+
+    async def scenario():
+        queue = BatchQueue(stuck_handler, 1, 0.01)
+        await queue.add(1)
+        await asyncio.sleep(0.05)
+        await asyncio.wait_for(queue.stop(timeout=0.2), 5)
+
+    asyncio.run(scenario())
+
+
+def test_batches_by_size():
+    sizes = []
+
+    async def handler(batch):
+        sizes.append(len(batch))
+
+    async def scenario():
+        queue = BatchQueue(handler, 50, 0.2, max_concurrency=2)
+        for i in range(125):
+            await queue.add(i)
+        await asyncio.sleep(0.5)
+        await queue.stop(timeout=5)
+
+    asyncio.run(scenario())
+    assert sizes == [50, 50, 25]
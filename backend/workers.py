@@ -0,0 +1,136 @@
+"""
+Shared machinery for the background writers (Supabase inserts, fulfillment webhooks)
+"""
+import asyncio
+import logging
+import random
+from typing import Any, Awaitable, Callable, List
+
+logger = logging.getLogger(__name__)
+
+
+# Queued by stop() to tell _run() to finish
+_STOP = object()
+
+
+def backoff_delay(attempt: int) -> float:
+    """Delay before retry number attempt + 1: exponential (1s, 2s, 4s, ... capped at 30s) plus up to 1s of jitter"""
+    return min(2 ** attempt, 30) + random.random()
+
+
+class BatchQueue:
+    """
+    Collect items and hand them to an async handler in batches.
+    A batch is flushed once it reaches max_batch_size items or when
+    max_wait_time seconds have passed since its first item arrived.
+    At most max_concurrency batches are handled at once; beyond that,
+    new items wait in the queue (which holds at most maxsize items,
+    0 meaning unbounded).
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[List[Any]], Awaitable[Any]],
+        max_batch_size: int,
+        max_wait_time: float,
+        maxsize: int = 0,
+        max_concurrency: int = 1
+    ):
+        self._handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._task: asyncio.Task | None = None
+        self._send_sem = asyncio.Semaphore(max_concurrency)
+        self._in_flight: set[asyncio.Task] = set()
+        # Batch collected by _run() when it was cancelled (stop() timed out); handled by stop()
+        self._unsent: List[Any] = []
+
+    def start(self) -> None:
+        """Start the background flush task if it is not already running"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        """
+        Stop the flush task after it has handed off everything queued so far,
+        then handle whatever is left. The task is stopped by queueing a
+        sentinel rather than by cancelling it: on Python 3.10/3.11 wait_for()
+        can swallow a cancellation, which left stop() waiting forever. If the
+        task or in-flight batches take longer than timeout seconds they are
+        cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            put_stop = asyncio.ensure_future(self._queue.put(_STOP))
+            done, _ = await asyncio.wait({task}, timeout=timeout)
+            put_stop.cancel()
+            if not done:
+                logger.warning("Batch queue did not stop within %.0fs, cancelling it", timeout)
+                task.cancel()
+                await asyncio.wait({task}, timeout=1.0)
+
+        if self._in_flight:
+            _, pending = await asyncio.wait(self._in_flight, timeout=max(deadline - loop.time(), 0.0))
+            for in_flight in pending:
+                in_flight.cancel()
+
+        items, self._unsent = self._unsent, []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not _STOP:
+                items.append(item)
+        for i in range(0, len(items), self.max_batch_size):
+            await self._handle(items[i:i + self.max_batch_size])
+
+    async def add(self, item: Any) -> None:
+        """Queue an item for the next batch (waits while the queue is full)"""
+        self.start()
+        await self._queue.put(item)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            stopping = False
+            try:
+                deadline = loop.time() + self.max_wait_time
+                while len(batch) < self.max_batch_size:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                await self._send_sem.acquire()
+            except asyncio.CancelledError:
+                # Keep the unsent batch aside (the queue may have refilled) so stop() handles it
+                self._unsent.extend(batch)
+                raise
+            task = asyncio.create_task(self._handle_and_release(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+            if stopping:
+                return
+
+    async def _handle_and_release(self, batch: List[Any]) -> None:
+        try:
+            await self._handle(batch)
+        finally:
+            self._send_sem.release()
+
+    async def _handle(self, batch: List[Any]) -> None:
+        try:
+            await self._handler(batch)
+        except Exception:
+            logger.exception("Error handling batch of %d item(s)", len(batch))